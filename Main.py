@@ -1,11 +1,28 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify  # pyright: ignore[reportMissingImports]
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, Response, stream_with_context  # pyright: ignore[reportMissingImports]
 import sqlite3
 import os
+import re
+import heapq
+import math
+import operator
+import functools
+import queue
+import threading
+import time
+import atexit
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import zstandard
+import blake3
+from cachetools import TTLCache
 import google.generativeai as genai  
 from werkzeug.utils import secure_filename
 import hashlib
+import hmac
 import json
-import uuid
+import secrets
 from dotenv import load_dotenv
 
 
@@ -14,14 +31,54 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+# Configure Gemini API over gRPC so every call reuses one long-lived HTTP/2 channel
+genai.configure(api_key=os.getenv("GEMINI_API_KEY"), transport='grpc')
 model = genai.GenerativeModel('gemini-2.0-flash')
+EMBEDDING_MODEL = 'models/text-embedding-004'
 DATABASE = 'code_analyser.db'
 
+# Background workers for Gemini code analysis so uploads return immediately
+EXECUTOR = ThreadPoolExecutor(max_workers=16)
+
+# Idle connections kept open between requests so SQLite's page cache survives
+DB_POOL_SIZE = 8
+_db_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+
+def connect_db():
+    """Open a new tuned database connection"""
+    conn = sqlite3.connect(DATABASE, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-20000')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+def get_db():
+    """Get the database connection for the current app context, reusing a pooled one if available"""
+    if 'db' not in g:
+        try:
+            g.db = _db_pool.get_nowait()
+        except queue.Empty:
+            g.db = connect_db()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    """Return the app context's connection to the pool instead of closing it"""
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _db_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
 def init_db():
     """Initialize the database with required tables"""
-    conn = sqlite3.connect(DATABASE)
+    conn = connect_db()
     cursor = conn.cursor()
     
     # Users table
@@ -44,11 +101,65 @@ def init_db():
             content TEXT NOT NULL,
             language TEXT,
             analysis TEXT,
+            content_hash TEXT,
+            token_set TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
     
+    # Databases created before content hashing and term extraction need the columns and a backfill
+    cursor.execute('PRAGMA table_info(code_files)')
+    columns = [column[1] for column in cursor.fetchall()]
+    if 'content_hash' not in columns:
+        cursor.execute('ALTER TABLE code_files ADD COLUMN content_hash TEXT')
+    if 'token_set' not in columns:
+        cursor.execute('ALTER TABLE code_files ADD COLUMN token_set TEXT')
+    cursor.execute('SELECT id, content FROM code_files WHERE content_hash IS NULL OR token_set IS NULL')
+    for file_id, content in cursor.fetchall():
+        cursor.execute('UPDATE code_files SET content_hash = ?, token_set = ? WHERE id = ?',
+                       (hash_content(content), serialize_terms(extract_terms(content)), file_id))
+    
+    # Indices for the per-user listing, chat history and analysis cache lookups
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_code_files_user_created ON code_files(user_id, created_at DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_code_files_hash ON code_files(content_hash)')
+    
+    # Full-text index over code files for BM25 ranking in RAG retrieval,
+    # kept in sync by triggers (skipped if SQLite was built without FTS5)
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'code_files_fts'")
+    fts_exists = cursor.fetchone() is not None
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS code_files_fts USING fts5(
+                content, filename, language,
+                content='code_files', content_rowid='id', tokenize='porter'
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS code_files_fts_insert AFTER INSERT ON code_files BEGIN
+                INSERT INTO code_files_fts (rowid, content, filename, language)
+                VALUES (new.id, new.content, new.filename, new.language);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS code_files_fts_delete AFTER DELETE ON code_files BEGIN
+                INSERT INTO code_files_fts (code_files_fts, rowid, content, filename, language)
+                VALUES ('delete', old.id, old.content, old.filename, old.language);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS code_files_fts_update AFTER UPDATE OF content, filename, language ON code_files BEGIN
+                INSERT INTO code_files_fts (code_files_fts, rowid, content, filename, language)
+                VALUES ('delete', old.id, old.content, old.filename, old.language);
+                INSERT INTO code_files_fts (rowid, content, filename, language)
+                VALUES (new.id, new.content, new.filename, new.language);
+            END
+        ''')
+        if not fts_exists:
+            cursor.execute("INSERT INTO code_files_fts (code_files_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError as e:
+        app.logger.warning(f"Full-text search unavailable, using keyword ranking: {str(e)}")
+    
     # Chat history table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS chat_history (
@@ -62,73 +173,212 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_user_session ON chat_history(user_id, session_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_chat_user_created ON chat_history(user_id, created_at)')
+    
+    # Semantic cache of RAG responses keyed by query embedding
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS query_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            context_key TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            query TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_query_cache_user ON query_cache(user_id, context_key, id)')
+    
+    # Re-queue analyses lost when the process stopped before they finished,
+    # only in the serving process (not the debug reloader's watcher)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true' or not app.debug:
+        cursor.execute('SELECT id, content, language FROM code_files WHERE analysis IS NULL')
+        for file_id, content, language in cursor.fetchall():
+            submit_analysis(file_id, content, language)
     
-    conn.commit()
     conn.close()
 
+# Large generated analyses are stored zstd-compressed.
+# Code content stays plain text because the FTS5 index reads it directly.
+ZSTD_LEVEL = 6
+_zstd = threading.local()
+
+def compress_text(text):
+    """Compress text for storage, using a per-thread compressor"""
+    if text is None:
+        return None
+    if not hasattr(_zstd, 'compressor'):
+        _zstd.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return _zstd.compressor.compress(text.encode())
+
+def decompress_text(value):
+    """Decompress stored text, passing through rows written before compression"""
+    if not isinstance(value, bytes):
+        return value
+    if not hasattr(_zstd, 'decompressor'):
+        _zstd.decompressor = zstandard.ZstdDecompressor()
+    return _zstd.decompressor.decompress(value).decode()
+
+def hash_content(content):
+    """Hash code content for analysis cache lookups using BLAKE3"""
+    return blake3.blake3(content.encode()).hexdigest()
+
+# scrypt cost parameters for password hashing
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+def _scrypt(password, salt):
+    return hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32)
+
 def hash_password(password):
-    """Hash password using SHA-256"""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hash password using salted scrypt, stored as salt$hash"""
+    salt = os.urandom(16)
+    return f"{salt.hex()}${_scrypt(password, salt).hex()}"
+
+def is_legacy_password_hash(password_hash):
+    """Check whether a hash predates scrypt (plain unsalted SHA-256)"""
+    return '$' not in password_hash
 
 def verify_password(password, password_hash):
-    """Verify password against hash"""
-    return hash_password(password) == password_hash
+    """Verify password against hash in constant time"""
+    if is_legacy_password_hash(password_hash):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), password_hash)
+    salt_hex, hash_hex = password_hash.split('$', 1)
+    return hmac.compare_digest(_scrypt(password, bytes.fromhex(salt_hex)).hex(), hash_hex)
+
+# Short-lived cache of existing users for login lookups
+_users_by_username = TTLCache(maxsize=1024, ttl=60)
+_user_cache_lock = threading.Lock()
 
 def get_user_by_username(username):
     """Get user by username"""
-    conn = sqlite3.connect(DATABASE)
+    with _user_cache_lock:
+        user = _users_by_username.get(username)
+    if user is not None:
+        return user
+    
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+    cursor.execute('SELECT id, username, password_hash FROM users WHERE username = ?', (username,))
     user = cursor.fetchone()
-    conn.close()
+    if user is not None:
+        with _user_cache_lock:
+            _users_by_username[username] = user
     return user
 
-def get_user_by_email(email):
-    """Get user by email"""
-    conn = sqlite3.connect(DATABASE)
+class BloomFilter:
+    """Bit-array Bloom filter: membership tests have no false negatives"""
+    
+    def __init__(self, capacity, error_rate):
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+    
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+    
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+    
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+# Bloom filters of registered usernames and emails, loaded on first signup,
+# let most signups skip the uniqueness query entirely
+USER_FILTER_CAPACITY = 100000
+USER_FILTER_ERROR_RATE = 0.01
+_username_filter = BloomFilter(USER_FILTER_CAPACITY, USER_FILTER_ERROR_RATE)
+_email_filter = BloomFilter(USER_FILTER_CAPACITY, USER_FILTER_ERROR_RATE)
+_user_filters_loaded = False
+_user_filters_lock = threading.Lock()
+
+def load_user_filters():
+    """Populate the username and email Bloom filters from the database once per process"""
+    global _user_filters_loaded
+    with _user_filters_lock:
+        if _user_filters_loaded:
+            return
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT username, email FROM users')
+        for user in cursor:
+            _username_filter.add(user['username'])
+            _email_filter.add(user['email'])
+        _user_filters_loaded = True
+
+def might_be_registered(username, email):
+    """Check the Bloom filters; False means neither the username nor the email is registered"""
+    load_user_filters()
+    with _user_filters_lock:
+        return username in _username_filter or email in _email_filter
+
+def find_taken_credentials(username, email):
+    """Check whether a username and email are already registered, in one query"""
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
-    user = cursor.fetchone()
-    conn.close()
-    return user
+    cursor.execute('SELECT username, email FROM users WHERE username = ? OR email = ?', (username, email))
+    users = cursor.fetchall()
+    username_taken = any(user['username'] == username for user in users)
+    email_taken = any(user['email'] == email for user in users)
+    return username_taken, email_taken
+
+def invalidate_user_cache(username):
+    """Drop a cached user lookup after the user's row changes"""
+    with _user_cache_lock:
+        _users_by_username.pop(username, None)
 
 def create_user(username, email, password):
     """Create a new user"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     password_hash = hash_password(password)
     cursor.execute('INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
                    (username, email, password_hash))
-    conn.commit()
     user_id = cursor.lastrowid
-    conn.close()
+    invalidate_user_cache(username)
+    with _user_filters_lock:
+        _username_filter.add(username)
+        _email_filter.add(email)
     return user_id
 
+def update_password_hash(user_id, username, password):
+    """Rehash a user's password with the current scheme"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE users SET password_hash = ? WHERE id = ?', (hash_password(password), user_id))
+    invalidate_user_cache(username)
+
 def save_code_file(user_id, filename, content, language=None):
     """Save uploaded code file"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('INSERT INTO code_files (user_id, filename, content, language) VALUES (?, ?, ?, ?)',
-                   (user_id, filename, content, language))
-    conn.commit()
+    cursor.execute('INSERT INTO code_files (user_id, filename, content, language, content_hash, token_set) VALUES (?, ?, ?, ?, ?, ?)',
+                   (user_id, filename, content, language, hash_content(content), serialize_terms(extract_terms(content))))
+    clear_query_cache(user_id)
     file_id = cursor.lastrowid
-    conn.close()
     return file_id
 
 def get_user_code_files(user_id):
     """Get all code files for a user"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM code_files WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
+    cursor.execute('SELECT id, filename, language, created_at, analysis IS NOT NULL AS analyzed FROM code_files WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
     files = cursor.fetchall()
-    conn.close()
     return files
 
-def analyze_code_with_gemini(code_content, language=None):
-    """Analyze code using Gemini API with enhanced analysis"""
-    try:
-        prompt = f"""
-        As an expert code reviewer, provide a comprehensive analysis of the following {language if language else 'code'}.
+# Common programming terms used for keyword relevance scoring in RAG retrieval
+_TERMS_RE = re.compile(r'\b(function|class|import|def|var|const|let|if|for|while|try|catch)\b')
+
+# Gemini prompt templates
+_ANALYZE_TEMPLATE = """
+        As an expert code reviewer, provide a comprehensive analysis of the following {language}.
         
         Please structure your analysis as follows:
         
@@ -153,7 +403,7 @@ def analyze_code_with_gemini(code_content, language=None):
         - Data protection concerns
         
         ## Best Practices & Recommendations
-        - Industry best practices for {language if language else 'this programming language'}
+        - Industry best practices for {practices_language}
         - Code improvement suggestions
         - Refactoring opportunities
         
@@ -163,36 +413,13 @@ def analyze_code_with_gemini(code_content, language=None):
         
         Code to analyze:
         ```
-        {code_content}
+        {code}
         ```
         
         Please provide a detailed, actionable analysis that will help the developer improve their code.
         """
-        
-        response = model.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        return f"Error analyzing code: {str(e)}"
 
-def get_rag_response(user_query, user_id):
-    """Generate RAG response using user's code context with enhanced retrieval"""
-    try:
-        # Get user's recent code files for context
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT content, filename, language, analysis FROM code_files WHERE user_id = ? ORDER BY created_at DESC LIMIT 10', (user_id,))
-        code_files = cursor.fetchall()
-        
-        # Get recent chat history for context
-        cursor.execute('SELECT user_message, bot_response FROM chat_history WHERE user_id = ? ORDER BY created_at DESC LIMIT 3', (user_id,))
-        chat_history = cursor.fetchall()
-        conn.close()
-        
-        # Enhanced context building with semantic relevance
-        context = build_semantic_context(user_query, code_files, chat_history)
-        
-        # Generate response with enhanced context
-        prompt = f"""
+_RAG_TEMPLATE = """
         You are an expert code analysis assistant with deep knowledge of programming best practices, debugging, and software engineering. 
         
         Based on the user's code context and their question, provide a comprehensive, helpful response.
@@ -200,7 +427,7 @@ def get_rag_response(user_query, user_id):
         CONTEXT:
         {context}
         
-        USER QUESTION: {user_query}
+        USER QUESTION: {query}
         
         INSTRUCTIONS:
         1. If the question is about specific code, reference the relevant code snippets
@@ -212,59 +439,304 @@ def get_rag_response(user_query, user_id):
         
         Please provide a detailed and helpful response:
         """
+
+def extract_terms(text):
+    """Get the set of programming terms that appear in text"""
+    return frozenset(_TERMS_RE.findall(text.lower()))
+
+def serialize_terms(terms):
+    """Serialize a term set for the code_files.token_set column"""
+    return ' '.join(sorted(terms))
+
+def load_terms(token_set):
+    """Load a term set stored in code_files.token_set"""
+    return frozenset(token_set.split()) if token_set else frozenset()
+
+# In-process LRU of analyses keyed by (content hash, language)
+ANALYSIS_CACHE_SIZE = 512
+_analysis_cache = OrderedDict()
+_analysis_cache_lock = threading.Lock()
+
+def get_cached_analysis(code_hash, language):
+    """Look up a previous analysis of identical code, in memory first and then in the database"""
+    key = (code_hash, language)
+    with _analysis_cache_lock:
+        if key in _analysis_cache:
+            _analysis_cache.move_to_end(key)
+            return _analysis_cache[key]
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT analysis FROM code_files WHERE content_hash = ? AND language IS ? AND analysis IS NOT NULL ORDER BY id DESC LIMIT 5',
+                   (code_hash, language))
+    for row in cursor.fetchall():
+        analysis = decompress_text(row[0])
+        if not analysis.startswith('Error analyzing code:'):
+            cache_analysis(code_hash, language, analysis)
+            return analysis
+    return None
+
+def cache_analysis(code_hash, language, analysis):
+    """Store an analysis in the in-process LRU"""
+    with _analysis_cache_lock:
+        _analysis_cache[(code_hash, language)] = analysis
+        _analysis_cache.move_to_end((code_hash, language))
+        if len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+            _analysis_cache.popitem(last=False)
+
+def analyze_code_with_gemini(code_content, language=None):
+    """Analyze code using Gemini API with enhanced analysis, reusing cached results for identical code"""
+    try:
+        code_hash = hash_content(code_content)
+        cached = get_cached_analysis(code_hash, language)
+        if cached is not None:
+            return cached
+        
+        prompt = _ANALYZE_TEMPLATE.format(language=language or 'code',
+                                          practices_language=language or 'this programming language',
+                                          code=code_content)
         
         response = model.generate_content(prompt)
+        cache_analysis(code_hash, language, response.text)
         return response.text
     except Exception as e:
-        return f"Error generating response: {str(e)}"
+        return f"Error analyzing code: {str(e)}"
+
+def run_analysis(file_id, code_content, language=None):
+    """Analyze an uploaded file in the background and store the result"""
+    with app.app_context():
+        analysis = analyze_code_with_gemini(code_content, language)
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE code_files SET analysis = ? WHERE id = ? AND analysis IS NULL', (compress_text(analysis), file_id))
+        
+        # Cached chat answers were built without this analysis
+        cursor.execute('SELECT user_id FROM code_files WHERE id = ?', (file_id,))
+        row = cursor.fetchone()
+        if row:
+            clear_query_cache(row['user_id'])
+
+def _analysis_done(file_id, future):
+    """Record a failed background analysis so the file does not stay pending forever"""
+    error = future.exception()
+    if error is None:
+        return
+    app.logger.error(f"Error analyzing file {file_id}: {str(error)}")
+    try:
+        with app.app_context():
+            conn = get_db()
+            cursor = conn.cursor()
+            cursor.execute('UPDATE code_files SET analysis = ? WHERE id = ? AND analysis IS NULL',
+                           (compress_text(f"Error analyzing code: {str(error)}"), file_id))
+    except Exception as e:
+        app.logger.error(f"Error recording failed analysis for file {file_id}: {str(e)}")
+
+def submit_analysis(file_id, code_content, language=None):
+    """Queue a background analysis, recording an error analysis if it fails"""
+    future = EXECUTOR.submit(run_analysis, file_id, code_content, language)
+    future.add_done_callback(functools.partial(_analysis_done, file_id))
+
+# Semantic query cache: a RAG response is reused when a new question's
+# embedding has cosine similarity above QUERY_CACHE_THRESHOLD with one of the
+# user's last QUERY_CACHE_SIZE questions
+QUERY_CACHE_SIZE = 100
+QUERY_CACHE_THRESHOLD = 0.92
+
+def embed_query(text):
+    """Embed a query as an L2-normalized float32 vector, or None if embedding fails"""
+    try:
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=text, task_type='semantic_similarity')
+    except Exception as e:
+        app.logger.warning(f"Error embedding query: {str(e)}")
+        return None
+    embedding = np.asarray(result['embedding'], dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm else None
+
+def get_cached_query_response(user_id, context_key, embedding):
+    """Find a cached response to a semantically similar earlier question asked in the same conversation context"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT embedding, response FROM query_cache WHERE user_id = ? AND context_key = ? ORDER BY id DESC LIMIT ?',
+                   (user_id, context_key, QUERY_CACHE_SIZE))
+    rows = cursor.fetchall()
+    if not rows:
+        return None
+    
+    matrix = np.stack([np.frombuffer(row['embedding'], dtype=np.float32) for row in rows])
+    similarities = np.einsum('ij,j->i', matrix, embedding)
+    best = int(np.argmax(similarities))
+    if similarities[best] > QUERY_CACHE_THRESHOLD:
+        return rows[best]['response']
+    return None
+
+def cache_query_response(user_id, context_key, user_query, embedding, response):
+    """Store a RAG response in the semantic cache, keeping the user's most recent entries"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO query_cache (user_id, context_key, embedding, query, response) VALUES (?, ?, ?, ?, ?)',
+                   (user_id, context_key, embedding.tobytes(), user_query, response))
+    cursor.execute('DELETE FROM query_cache WHERE user_id = ? AND id NOT IN (SELECT id FROM query_cache WHERE user_id = ? ORDER BY id DESC LIMIT ?)',
+                   (user_id, user_id, QUERY_CACHE_SIZE))
+
+def clear_query_cache(user_id):
+    """Drop a user's cached RAG responses once their code changes"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM query_cache WHERE user_id = ?', (user_id,))
+
+def get_rag_response(user_query, user_id):
+    """Generate RAG response using user's code context with enhanced retrieval.
+
+    Returns a (chunks, code_files) tuple: chunks yields the response text as
+    Gemini streams it, and code_files lets callers reuse the retrieved files
+    without querying them again.
+    """
+    code_files = []
+    try:
+        # Get user's recent code files for context, truncated in SQL to what
+        # the prompt uses (one extra character shows whether it was cut)
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, substr(content, 1, 1001) AS content, filename, language FROM code_files WHERE user_id = ? ORDER BY created_at DESC LIMIT 10', (user_id,))
+        code_files = cursor.fetchall()
+        
+        # Get recent chat history for context
+        flush_chat_messages()
+        cursor.execute('SELECT id, user_message, substr(bot_response, 1, 200) AS bot_response FROM chat_history WHERE user_id = ? ORDER BY created_at DESC LIMIT 3', (user_id,))
+        chat_history = cursor.fetchall()
+        
+        # Serve semantically equivalent questions from the query cache. Only
+        # entries cached against the same recent history (identified by its
+        # newest turn) are compared, so follow-ups such as "why?" never reuse
+        # an answer from another conversation.
+        context_key = str(chat_history[0]['id']) if chat_history else ''
+        embedding = embed_query(user_query)
+        if embedding is not None:
+            cached = get_cached_query_response(user_id, context_key, embedding)
+            if cached is not None:
+                return iter([cached]), code_files
+        
+        # Rank files with full-text search, which returns its own snippets and
+        # analyses; keyword ranking needs the recent files' analyses and term sets
+        ranked_files = search_code_files(user_id, user_query)
+        if ranked_files is None:
+            code_files = get_keyword_ranking_files(code_files)
+        
+        # Enhanced context building with semantic relevance
+        context = build_semantic_context(user_query, code_files, chat_history, ranked_files)
+        
+        # Generate response with enhanced context
+        prompt = _RAG_TEMPLATE.format(context=context, query=user_query)
+        
+        response = model.generate_content(prompt, stream=True)
+        
+        def on_complete(text):
+            if embedding is not None:
+                cache_query_response(user_id, context_key, user_query, embedding, text)
+        
+        return stream_response_text(response, on_complete), code_files
+    except Exception as e:
+        return iter([f"Error generating response: {str(e)}"]), code_files
+
+def stream_response_text(response, on_complete=None):
+    """Yield the text of each chunk of a streamed Gemini response, passing the full text to on_complete if it succeeds"""
+    parts = []
+    try:
+        for chunk in response:
+            parts.append(chunk.text)
+            yield chunk.text
+    except Exception as e:
+        yield f"Error generating response: {str(e)}"
+        return
+    if on_complete:
+        on_complete(''.join(parts))
+
+def search_code_files(user_id, user_query, limit=3):
+    """Rank a user's code files against a query with FTS5 BM25, returning snippets.
+
+    Returns None if the full-text index is unavailable so callers can fall
+    back to keyword ranking.
+    """
+    terms = re.findall(r'\w+', user_query.lower())
+    if not terms:
+        return []
+    match = ' OR '.join(f'"{term}"' for term in terms)
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute('''
+            SELECT snippet(code_files_fts, 0, '', '', '...', 64), f.filename, f.language, f.analysis
+            FROM code_files_fts JOIN code_files f ON f.id = code_files_fts.rowid
+            WHERE code_files_fts MATCH ? AND f.user_id = ?
+            ORDER BY bm25(code_files_fts) LIMIT ?
+        ''', (match, user_id, limit))
+    except sqlite3.OperationalError:
+        return None
+    return cursor.fetchall()
 
-def build_semantic_context(user_query, code_files, chat_history):
-    """Build semantic context based on query relevance"""
+def get_keyword_ranking_files(code_files):
+    """Add the analyses and term sets keyword ranking needs to the recent code files"""
+    if not code_files:
+        return []
+    file_ids = [file['id'] for file in code_files]
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT id, analysis, token_set FROM code_files WHERE id IN ({', '.join('?' * len(file_ids))})", file_ids)
+    extra = {row['id']: row for row in cursor.fetchall()}
+    return [dict(file, analysis=extra[file['id']]['analysis'], token_set=extra[file['id']]['token_set'])
+            for file in code_files if file['id'] in extra]
+
+def build_semantic_context(user_query, code_files, chat_history, ranked_files=None):
+    """Build semantic context based on query relevance, using FTS-ranked files when available"""
     context_parts = []
     
     # Add recent chat context
     if chat_history:
         context_parts.append("RECENT CONVERSATION CONTEXT:")
-        for user_msg, bot_resp in reversed(chat_history):
-            context_parts.append(f"User: {user_msg}")
-            context_parts.append(f"Assistant: {bot_resp[:200]}...")
+        for turn in reversed(chat_history):
+            context_parts.append(f"User: {turn['user_message']}")
+            context_parts.append(f"Assistant: {turn['bot_response'][:200]}...")
         context_parts.append("")
     
-    # Analyze query to determine relevant code files
-    query_lower = user_query.lower()
-    relevant_files = []
-    
-    # Simple keyword matching for relevance
-    for content, filename, language, analysis in code_files:
-        relevance_score = 0
-        
-        # Check for language-specific queries
-        if language and language.lower() in query_lower:
-            relevance_score += 3
-        
-        # Check for filename mentions
-        if filename.lower() in query_lower:
-            relevance_score += 2
-        
-        # Check for common programming terms in content
-        programming_terms = ['function', 'class', 'import', 'def', 'var', 'const', 'let', 'if', 'for', 'while', 'try', 'catch']
-        for term in programming_terms:
-            if term in query_lower and term in content.lower():
-                relevance_score += 1
+    if ranked_files is not None:
+        # Full-text search already ranked the files
+        relevant_files = ranked_files
+    else:
+        # Simple keyword matching for relevance when full-text ranking is unavailable
+        query_lower = user_query.lower()
+        query_terms = extract_terms(query_lower)
+        scored_files = []
+        for file in code_files:
+            content, filename, language = file['content'], file['filename'], file['language']
+            relevance_score = 0
+            
+            # Check for language-specific queries
+            if language and language.lower() in query_lower:
+                relevance_score += 3
+            
+            # Check for filename mentions
+            if filename.lower() in query_lower:
+                relevance_score += 2
+            
+            # Check for common programming terms shared by query and content
+            if query_terms:
+                relevance_score += len(query_terms & load_terms(file['token_set']))
+            
+            if relevance_score > 0:
+                scored_files.append((relevance_score, content, filename, language, file['analysis']))
         
-        if relevance_score > 0:
-            relevant_files.append((relevance_score, content, filename, language, analysis))
-    
-    # Sort by relevance and take top files
-    relevant_files.sort(key=lambda x: x[0], reverse=True)
-    relevant_files = relevant_files[:3]  # Top 3 most relevant files
+        # Take the top 3 most relevant files without sorting them all
+        relevant_files = [file[1:] for file in heapq.nlargest(3, scored_files, key=operator.itemgetter(0))]
     
     # Add relevant code context
     if relevant_files:
         context_parts.append("RELEVANT CODE FILES:")
-        for _, content, filename, language, analysis in relevant_files:
+        for content, filename, language, analysis in relevant_files:
             context_parts.append(f"File: {filename} (Language: {language})")
             context_parts.append(f"Code:\n{content[:1000]}{'...' if len(content) > 1000 else ''}")
+            analysis = decompress_text(analysis)
             if analysis:
                 context_parts.append(f"Previous Analysis: {analysis[:500]}{'...' if len(analysis) > 500 else ''}")
             context_parts.append("")
@@ -272,35 +744,98 @@ def build_semantic_context(user_query, code_files, chat_history):
     # Add general code context if no specific matches
     if not relevant_files and code_files:
         context_parts.append("USER'S RECENT CODE FILES:")
-        for content, filename, language, analysis in code_files[:2]:  # Top 2 recent files
-            context_parts.append(f"File: {filename} (Language: {language})")
+        for file in code_files[:2]:  # Top 2 recent files
+            content = file['content']
+            context_parts.append(f"File: {file['filename']} (Language: {file['language']})")
             context_parts.append(f"Code:\n{content[:800]}{'...' if len(content) > 800 else ''}")
             context_parts.append("")
     
     return "\n".join(context_parts)
 
+# Chat messages are buffered and written in batches, flushed every
+# CHAT_FLUSH_SIZE messages, every CHAT_FLUSH_INTERVAL seconds and before reads
+CHAT_FLUSH_SIZE = 32
+CHAT_FLUSH_INTERVAL = 2.0
+_chat_buffer = deque()
+_chat_buffer_lock = threading.Lock()
+_chat_flush_lock = threading.Lock()
+_chat_flusher = None
+
+def flush_chat_messages():
+    """Write all buffered chat messages in a single transaction"""
+    with _chat_flush_lock:
+        with _chat_buffer_lock:
+            rows = list(_chat_buffer)
+            _chat_buffer.clear()
+        if not rows:
+            return
+        
+        conn = None
+        try:
+            conn = get_db()
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany('INSERT INTO chat_history (user_id, session_id, user_message, bot_response, code_context, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                             rows)
+            conn.execute('COMMIT')
+        except Exception:
+            if conn is not None and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            # Keep the messages for the next flush
+            with _chat_buffer_lock:
+                _chat_buffer.extendleft(reversed(rows))
+            raise
+
+def _run_chat_flusher():
+    """Periodically flush buffered chat messages from a background thread"""
+    while True:
+        time.sleep(CHAT_FLUSH_INTERVAL)
+        try:
+            with app.app_context():
+                flush_chat_messages()
+        except Exception as e:
+            app.logger.exception(f"Error flushing chat messages: {str(e)}")
+
+def _start_chat_flusher():
+    """Start the background chat flusher once per process"""
+    global _chat_flusher
+    with _chat_buffer_lock:
+        if _chat_flusher is None:
+            _chat_flusher = threading.Thread(target=_run_chat_flusher, daemon=True)
+            _chat_flusher.start()
+
+@atexit.register
+def _flush_chat_messages_at_exit():
+    with app.app_context():
+        flush_chat_messages()
+
 def save_chat_message(user_id, session_id, user_message, bot_response, code_context=None):
     """Save chat message to database with enhanced context tracking"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    
     # Truncate context if too long for database
     if code_context and len(code_context) > 5000:
         code_context = code_context[:5000] + "... [truncated]"
     
-    cursor.execute('INSERT INTO chat_history (user_id, session_id, user_message, bot_response, code_context) VALUES (?, ?, ?, ?, ?)',
-                   (user_id, session_id, user_message, bot_response, code_context))
-    conn.commit()
-    conn.close()
+    created_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    with _chat_buffer_lock:
+        _chat_buffer.append((user_id, session_id, user_message, bot_response, code_context, created_at))
+        pending = len(_chat_buffer)
+    
+    _start_chat_flusher()
+    if pending >= CHAT_FLUSH_SIZE:
+        # Called after a reply has streamed, so a failed flush must not abort
+        # the response; the rows stay buffered for the background flusher
+        try:
+            flush_chat_messages()
+        except Exception as e:
+            app.logger.exception(f"Error flushing chat messages: {str(e)}")
 
 def get_chat_history(user_id, session_id):
     """Get chat history for a session"""
-    conn = sqlite3.connect(DATABASE)
+    flush_chat_messages()
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM chat_history WHERE user_id = ? AND session_id = ? ORDER BY created_at ASC', 
+    cursor.execute('SELECT user_message, bot_response FROM chat_history WHERE user_id = ? AND session_id = ? ORDER BY created_at ASC', 
                    (user_id, session_id))
     history = cursor.fetchall()
-    conn.close()
     return history
 
 # Routes
@@ -317,9 +852,11 @@ def login():
         password = request.form['password']
         
         user = get_user_by_username(username)
-        if user and verify_password(password, user[3]):
-            session['user_id'] = user[0]
-            session['username'] = user[1]
+        if user and verify_password(password, user['password_hash']):
+            if is_legacy_password_hash(user['password_hash']):
+                update_password_hash(user['id'], user['username'], password)
+            session['user_id'] = user['id']
+            session['username'] = user['username']
             flash('Login successful!', 'success')
             return redirect(url_for('dashboard'))
         else:
@@ -340,11 +877,16 @@ def signup():
             flash('Passwords do not match', 'error')
             return render_template('signup.html')
         
-        if get_user_by_username(username):
+        # Only query the database when the Bloom filters say either may be registered
+        username_taken = email_taken = False
+        if might_be_registered(username, email):
+            username_taken, email_taken = find_taken_credentials(username, email)
+        
+        if username_taken:
             flash('Username already exists', 'error')
             return render_template('signup.html')
         
-        if get_user_by_email(email):
+        if email_taken:
             flash('Email already exists', 'error')
             return render_template('signup.html')
         
@@ -352,6 +894,9 @@ def signup():
             create_user(username, email, password)
             flash('Account created successfully! Please login.', 'success')
             return redirect(url_for('login'))
+        except sqlite3.IntegrityError:
+            # Registered by another worker after this process loaded its filters
+            flash('Username or email already exists', 'error')
         except Exception as e:
             flash('Error creating account', 'error')
     
@@ -391,17 +936,10 @@ def upload_code():
             user_id = session['user_id']
             file_id = save_code_file(user_id, filename, code_content, language)
             
-            # Analyze code with Gemini
-            analysis = analyze_code_with_gemini(code_content, language)
-            
-            # Update analysis in database
-            conn = sqlite3.connect(DATABASE)
-            cursor = conn.cursor()
-            cursor.execute('UPDATE code_files SET analysis = ? WHERE id = ?', (analysis, file_id))
-            conn.commit()
-            conn.close()
+            # Analyze code with Gemini in the background
+            submit_analysis(file_id, code_content, language)
             
-            flash('Code uploaded and analyzed successfully!', 'success')
+            flash('Code uploaded successfully! Analysis will appear on your dashboard shortly.', 'success')
             return redirect(url_for('dashboard'))
         else:
             flash('Please provide both filename and code content', 'error')
@@ -416,7 +954,7 @@ def chat():
         return redirect(url_for('login'))
     
     if 'session_id' not in session:
-        session['session_id'] = str(uuid.uuid4())
+        session['session_id'] = secrets.token_hex(16)
     
     user_id = session['user_id']
     session_id = session['session_id']
@@ -425,30 +963,44 @@ def chat():
         user_message = request.form['user_message']
         if user_message:
             # Generate RAG response with enhanced context
-            bot_response = get_rag_response(user_message, user_id)
-            
-            # Get the context used for this response
-            conn = sqlite3.connect(DATABASE)
-            cursor = conn.cursor()
-            cursor.execute('SELECT content, filename, language FROM code_files WHERE user_id = ? ORDER BY created_at DESC LIMIT 5', (user_id,))
-            code_files = cursor.fetchall()
-            conn.close()
+            chunks, code_files = get_rag_response(user_message, user_id)
             
             # Build context summary for storage
             context_summary = f"Query: {user_message}\nRelevant files: {len(code_files)} code files analyzed"
             
-            # Save to chat history with context
-            save_chat_message(user_id, session_id, user_message, bot_response, context_summary)
+            def generate():
+                # Stream chunks to the client as server-sent events
+                parts = []
+                for text in chunks:
+                    parts.append(text)
+                    yield f"data: {json.dumps({'text': text})}\n\n"
+                
+                # Save to chat history with context once the response is complete
+                save_chat_message(user_id, session_id, user_message, ''.join(parts), context_summary)
+                yield "event: done\ndata: {}\n\n"
             
-            return jsonify({
-                'user_message': user_message,
-                'bot_response': bot_response
-            })
+            return Response(stream_with_context(generate()), mimetype='text/event-stream')
     
     # Get chat history
     chat_history = get_chat_history(user_id, session_id)
     return render_template('chat.html', chat_history=chat_history)
 
+@app.route('/analysis_status/<int:file_id>')
+def analysis_status(file_id):
+    """Report whether a code file's background analysis has finished"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'Please login to check analysis status'}), 401
+    
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT analysis IS NOT NULL FROM code_files WHERE id = ? AND user_id = ?', (file_id, session['user_id']))
+    row = cursor.fetchone()
+    
+    if not row:
+        return jsonify({'error': 'File not found'}), 404
+    
+    return jsonify({'file_id': file_id, 'status': 'analyzed' if row[0] else 'pending'})
+
 @app.route('/analyze/<int:file_id>')
 def analyze_code(file_id):
     """Analyze specific code file"""
@@ -456,16 +1008,16 @@ def analyze_code(file_id):
         flash('Please login to analyze code', 'error')
         return redirect(url_for('login'))
     
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM code_files WHERE id = ? AND user_id = ?', (file_id, session['user_id']))
+    cursor.execute('SELECT id, filename, content, language, analysis, created_at FROM code_files WHERE id = ? AND user_id = ?', (file_id, session['user_id']))
     file_data = cursor.fetchone()
-    conn.close()
     
     if not file_data:
         flash('File not found', 'error')
         return redirect(url_for('dashboard'))
     
+    file_data = dict(file_data, analysis=decompress_text(file_data['analysis']))
     return render_template('analysis.html', file_data=file_data)
 
 @app.route('/delete/<int:file_id>', methods=['POST'])
@@ -475,24 +1027,24 @@ def delete_file(file_id):
         flash('Please login to delete files', 'error')
         return redirect(url_for('login'))
     
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Check if file belongs to user
-    cursor.execute('SELECT * FROM code_files WHERE id = ? AND user_id = ?', (file_id, session['user_id']))
+    cursor.execute('SELECT id FROM code_files WHERE id = ? AND user_id = ?', (file_id, session['user_id']))
     file_data = cursor.fetchone()
     
     if file_data:
         # Delete the file
         cursor.execute('DELETE FROM code_files WHERE id = ? AND user_id = ?', (file_id, session['user_id']))
-        conn.commit()
+        clear_query_cache(session['user_id'])
         flash('File deleted successfully!', 'success')
     else:
         flash('File not found or access denied', 'error')
     
-    conn.close()
     return redirect(url_for('dashboard'))
 
 if __name__ == '__main__':
+    app.debug = True
     init_db()
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    app.run(host='0.0.0.0', port=5000)